@@ -1,34 +1,51 @@
 #!/usr/bin/python3
 
 import sys
+import os
 import json
+import math
 from pathlib import Path
-from functools import lru_cache
-from urllib.parse import urlparse, urlunparse
+from functools import lru_cache, cached_property
+from concurrent.futures import ThreadPoolExecutor
 import re
+import time
 import logging
 import socket
+import subprocess
+import threading
+import queue
+from collections import OrderedDict
 
-import requests
-import requests.utils
-import git
-import toml
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
-from . import utils
+from .cache import HttpCache, NameCache
 
-logging.getLogger().setLevel(logging.DEBUG)
-logging.getLogger('git').setLevel(logging.WARN)
-logging.getLogger("urllib3").setLevel(logging.WARN)
+logger = logging.getLogger(__name__)
 
 PROGNAME = 'ripio'
 BITBUCKET = 'bitbucket.org'
 GITHUB = 'github.com'
+CACHE_DIR = Path.home() / '.cache' / PROGNAME
+HTTP_WORKERS = 8
 
 sites = {
     BITBUCKET: 'bitbucket',
     GITHUB: 'github',
 }
 
+MAX_ORIGIN_LENGTH = 2048
+# ssh://git@host/name.git | git@host:name.git | https://[user@]host/name[.git]
+ORIGIN_RE = re.compile(
+    r'(?:ssh://git@([^/]+)/|git@([^:/]+):|https://(?:[^/@]+@)?([^/]+)/)(.+?)(?:\.git)?\Z')
+
+WORKSPACE_RE = re.compile(r'(?:([^:/]+):)?([^:/]+)\Z')
+GITHUB_PAGE_RE = re.compile(r'([?&]page=)(\d+)')
+URL_PASSWORD_RE = re.compile(r'(://[^:/@]+):[^@/]+@')
+
+CONFIG_SECTIONS = {'bitbucket', 'github', 'clone', 'cache'}
 SITE_ABBREVS = {
     'bitbucket': 'bitbucket',
     'bb':        'bitbucket',
@@ -41,6 +58,10 @@ Provide a config file with --config argument or its default location: '~/.config
     [clone]
     destdir = "~/repos"
 
+    [cache]    # optional, API replies kept in '~/.cache/ripio'
+    ttl = 300
+    max_entries = 1000
+
     [bitbucket]
     credentials = "JohnDoe:secret"
     workspaces = ["team1", "team2"]
@@ -56,22 +77,16 @@ Use these features to create "safe" credentials:
 
 
 class error(Exception):
+    reason = None
+
     def __init__(self, *args):
         self.value = None
 
     def __str__(self):
-        msg = "- " + getattr(self, 'reason', self.__class__.__name__)
-        msg += ": {}".format(self.get_value())
-
-        return msg
+        return "- {}: {}".format(self.reason or type(self).__name__, self.get_value())
 
     def get_value(self):
-        if self.value:
-            return self.value
-        if len(self.args):
-            return self.args[0]
-
-        return ''
+        return self.value or (self.args[0] if self.args else '')
 
     def detail(self, msg):
         return "\n- " + msg
@@ -133,33 +148,163 @@ class RateLimitExceeded(error):
 class NetworkError(error):
     pass
 
+class BatchFailed(error):
+    reason = "batch commands failed"
+
+
+def configure_logging(level):
+    logging.basicConfig()
+    logging.getLogger().setLevel(level)
+    logging.getLogger('git').setLevel(logging.WARN)
+    logging.getLogger("urllib3").setLevel(logging.WARN)
+
+
+def make_session():
+    "keep-alive session shared by all API calls"
+    # requests is imported on demand, commands not using the network skip its load time
+    import requests
+    from requests.adapters import HTTPAdapter
+    from urllib3.util.retry import Retry
+
+    # only safe methods are retried: a repeated POST, PUT or DELETE whose first
+    # attempt went through would fail (AlreadyExists, RepositoryNotFound) or
+    # recreate a renamed repository
+    retries = Retry(total=5, backoff_factor=0.5,
+                    allowed_methods=frozenset(['GET', 'HEAD']),
+                    status_forcelist=[429, 500, 502, 503, 504],
+                    respect_retry_after_header=True,
+                    raise_on_status=False)
+    adapter = HTTPAdapter(pool_connections=4, pool_maxsize=16, max_retries=retries)
+
+    session = requests.Session()
+    session.mount('https://', adapter)
+    session.headers['User-Agent'] = PROGNAME
+    return session
+
+
+_session = None
+_session_lock = threading.Lock()
+
+
+def get_session():
+    global _session
+
+    with _session_lock:
+        if _session is None:
+            _session = make_session()
+
+    return _session
+
+
+_cache = None
+_names = None
+
+
+def enable_cache(path=CACHE_DIR / 'http', expire_after=300, max_entries=1000):
+    global _cache
+    _cache = HttpCache(path, expire_after, max_entries)
+
+
+def enable_name_cache(fname=CACHE_DIR / 'names.json'):
+    global _names
+    _names = NameCache(fname)
+
+
+def http_request(method, url, **kargs):
+    # any change on the server may make cached replies and name completions stale
+    if method != 'GET':
+        with _repo_data_lock:
+            _repo_data.clear()
+
+        if _cache is not None:
+            _cache.clear()
+
+        if _names is not None:
+            _names.clear()
+
+    return http_send(method, url, **kargs)
+
+
+def http_send(method, url, **kargs):
+    "plain request, bypassing the HTTP cache"
+    import requests
 
-def http_get(*args, **kargs):
     try:
-        return requests.get(*args, **kargs)
+        return get_session().request(method, url, **kargs)
     except requests.exceptions.ConnectionError as e:
         raise NetworkError(e)
 
 
+def reply_json(reply):
+    "orjson (if available) parses raw bytes several times faster than the stdlib"
+    if orjson is None:
+        return reply.json()
+
+    return orjson.loads(reply.content)
+
+
+def http_get(url, **kargs):
+    if _cache is None:
+        return http_request('GET', url, **kargs)
+
+    def fetch(headers):
+        return http_request('GET', url, headers=headers, **kargs)
+
+    return _cache.get(url, kargs.get('auth'), fetch)
+
+
+REPO_DATA_MAX = 1024
+_repo_data = OrderedDict()
+_repo_data_lock = threading.Lock()
+
+
+def get_repo_data(url, auth, check):
+    "successful repository data, shared by all Repo instances until something changes"
+    key = (url, auth)
+    with _repo_data_lock:
+        if key in _repo_data:
+            _repo_data.move_to_end(key)
+            return dict(_repo_data[key])
+
+    reply = http_get(url, auth=auth)
+    check(reply)
+    data = reply_json(reply)
+
+    # least recently used entries are dropped
+    with _repo_data_lock:
+        _repo_data[key] = data
+        if len(_repo_data) > REPO_DATA_MAX:
+            _repo_data.popitem(last=False)
+
+    return dict(data)
+
+
 class WorkspaceName:
+    __slots__ = ('site', 'workspace')
+
     def __init__(self, full_workspace, site=None):
-        if full_workspace.count(':') > 1 or '/' in full_workspace:
+        match = WORKSPACE_RE.match(full_workspace)
+        if match is None:
             raise BadWorkspaceName(full_workspace)
 
-        try:
-            self.site, self.workspace = full_workspace.split(':')
-        except ValueError:
+        self.site, self.workspace = match.groups()
+        if self.site is None:
             if site is None:
                 raise BadWorkspaceName(full_workspace)
 
             self.site = site
-            self.workspace = full_workspace
 
         try:
             self.site = SITE_ABBREVS[self.site]
         except KeyError:
             raise UnsupportedSite(self.site)
 
+    @staticmethod
+    @lru_cache(maxsize=256)
+    def cached(full_workspace, site=None):
+        "names are never modified, so instances can be shared"
+        return WorkspaceName(full_workspace, site)
+
     def __repr__(self):
         return "<WorkspaceName '{}:{}'>".format(self.site, self.workspace)
 
@@ -168,38 +313,38 @@ class WorkspaceName:
 
 
 class RepoRef:
+    __slots__ = ('owner', 'slug', 'site', 'full_name', 'global_name')
+
     def __init__(self, site_full_name, site=None):
         if site_full_name.startswith(('https://', 'git@', 'ssh://')):
             site_full_name = RepoRef.parse_origin(site_full_name)
 
-        if site_full_name.count('/') != 1:
+        self.owner, sep, self.slug = site_full_name.partition('/')
+        if not sep or '/' in self.slug:
             raise BadRepositoryName(site_full_name)
 
-        try:
-            self.owner, self.slug = site_full_name.split('/')
-        except ValueError:
-            raise BadRepositoryName(site_full_name)
-
-        self.owner = WorkspaceName(self.owner, site=site)
+        self.owner = WorkspaceName.cached(self.owner, site)
         self.site = self.owner.site
         self.full_name = '{}/{}'.format(self.owner.workspace, self.slug)
         self.global_name = '{}:{}'.format(self.site, self.full_name)
 
     @classmethod
+    @lru_cache(maxsize=128)
     def parse_origin(cls, url):
-        if url.startswith('ssh://'):
-            fields = re.findall(r'\Assh://git@([^/]+)/(.+).git\Z', url)[0]
+        # no real origin is that long, do not feed huge strings to the regex engine
+        if len(url) > MAX_ORIGIN_LENGTH:
+            raise BadRepositoryName(url[:64] + '...')
 
-        elif url.startswith('git@'):
-            fields = re.findall(r'\Agit@([^:]+):(.+).git\Z', url)[0]
-
-        elif url.startswith('https://'):
-            fields = re.findall(r'\Ahttps?://([^/]+)/(.+)(?:\.git)?\Z', url)[0]
-
-        else:
+        match = ORIGIN_RE.match(url)
+        if match is None:
             raise BadRepositoryName(url)
 
-        return '{}:{}'.format(sites[fields[0]], fields[1])
+        ssh_host, git_host, https_host, full_name = match.groups()
+        host = ssh_host or git_host or https_host
+        try:
+            return '{}:{}'.format(sites[host], full_name)
+        except KeyError:
+            raise UnsupportedSite(host)
 
     @classmethod
     def from_origin(cls, url):
@@ -207,7 +352,7 @@ class RepoRef:
 
     @classmethod
     def from_parts(cls, workspace, name, site=None):
-        return RepoRef(workspace + '/' + name, site=site)
+        return RepoRef.cached(workspace + '/' + name, site)
 
     def __eq__(self, other):
         assert isinstance(other, RepoRef)
@@ -218,7 +363,13 @@ class RepoRef:
         if isinstance(name, RepoRef):
             return name
 
-        return RepoRef(name, site)
+        return RepoRef.cached(name, site)
+
+    @staticmethod
+    @lru_cache(maxsize=1024)
+    def cached(site_full_name, site=None):
+        "references are never modified, so instances can be shared"
+        return RepoRef(site_full_name, site)
 
     def __repr__(self):
         return "<RepoRef '{}'>".format(self)
@@ -231,6 +382,7 @@ class Completion:
     def __init__(self, name, config):
         self.found = []
         self.denied = []
+        self.cached = False
         self.workspaces = self.list_workspaces(config)
 
         if not self.workspaces:
@@ -240,7 +392,9 @@ class Completion:
 
         if not self.found and not self.denied:
             workspaces = str.join('\n', [" - {}".format(x) for x in self.workspaces])
-            logging.error("No guess found for any known workspace:\n{}".format(workspaces))
+            logger.error("No guess found for any known workspace:\n%s", workspaces)
+            if self.cached:
+                logger.error("Cached result, use --refresh to check the sites again")
             raise WrongCompletion(name)
 
     def complete(self, name, config):
@@ -254,84 +408,132 @@ class Completion:
 
         # for site:name names
         if name.count(':') == 1:
-            site, name = name.split(':')
+            site, _, name = name.partition(':')
             workspaces = [ws for ws in workspaces if ws.site == SITE_ABBREVS[site]]
 
-        for ws in workspaces:
+        key = '{} {}'.format(name, str.join(',', [str(ws) for ws in workspaces]))
+        if _names is not None:
+            found = _names.get(key)
+            if found is not None:
+                self.found = found
+                self.cached = True
+                return
+
+        def probe(ws):
+            repo = ws.make_repo(name)
             try:
-                repo = ws.make_repo(name)
-                if repo.checked_exists():
-                    self.found.append(repo.ref.global_name)
+                return repo, repo.checked_exists()
             except AccessDenied:
-                self.denied.append(repo.ref.global_name)
+                return repo, None
+
+        # workspaces are probed concurrently, results keep the workspace order
+        with ThreadPoolExecutor(max_workers=HTTP_WORKERS) as pool:
+            for repo, exists in pool.map(probe, workspaces):
+                if exists is None:
+                    self.denied.append(repo.ref.global_name)
+                elif exists:
+                    self.found.append(repo.ref.global_name)
+
+        # denied probes may succeed with other credentials, do not remember them
+        if _names is not None and not self.denied:
+            _names.set(key, self.found)
 
     @classmethod
     def list_workspaces(cls, config):
         retval = []
-        ws_class = {'bitbucket': BitbucketWorkspace,
-                    'github':    GithubWorkspace}
-        sites = ws_class.keys()
-
-        for site in sites:
+        for site in WORKSPACE_CLASSES:
             credentials = config.get_credentials(site)
             try:
                 name = credentials.username
-                retval.append(ws_class[site](name, credentials))
+                retval.append(WORKSPACE_CLASSES[site](name, credentials))
             except AttributeError:
-                logging.debug("No credentials found for '{}'".format(site))
+                logger.debug("No credentials found for '%s'", site)
 
             try:
                 for name in config.get_workspaces(site):
-                    retval.append(ws_class[site](name, credentials))
+                    retval.append(WORKSPACE_CLASSES[site](name, credentials))
             except AttributeError as e:
-                logging.debug(e)
+                logger.debug("%s", e)
 
         return retval
 
 
+@lru_cache(maxsize=8)
+def load_toml(fname, mtime_ns, size):
+    "file stat is part of the key, so edited files are parsed again"
+    try:
+        import tomllib
+    except ImportError:
+        import tomli as tomllib
+
+    with open(fname, 'rb') as f:
+        return tomllib.load(f)
+
+
 class ConfigFile:
     def __init__(self, fname=None):
+        self.credentials_cache = {}
+        self.workspaces_cache = {}
+        self.fname = fname
+        self.toml = {}
+
         if not fname:
-            self.data = utils.dictToObject({})
             return
 
         try:
-            self.fname = fname
-            self.toml = toml.load(fname)
-            self.data = utils.dictToObject(self.toml)
-        except toml.decoder.TomlDecodeError as e:
-            logging.error("Wrong config file:\n  {}\n".format(e))
+            stat = os.stat(fname)
+            self.toml = load_toml(fname, stat.st_mtime_ns, stat.st_size)
+        except ValueError as e:  # TOMLDecodeError
+            logger.error("Wrong config file:\n  %s\n", e)
             print(CONFIG_USAGE)
             sys.exit(1)
 
-    def __getattr__(self, key):
-        return getattr(self.data, key)
+    def section(self, site):
+        return self.toml.get(site) or {}
 
     def get_credentials(self, site):
-        try:
-            site = getattr(self, site)
-            return Credentials(site.credentials)
-        except AttributeError:
-            return None
+        if site not in self.credentials_cache:
+            credentials = self.section(site).get('credentials')
+            # deprecated format: a [site.credentials] table
+            if not isinstance(credentials, str):
+                credentials = None
+
+            self.credentials_cache[site] = Credentials.make(credentials)
+
+        return self.credentials_cache[site]
 
     def get_workspaces(self, site):
-        try:
-            return getattr(self.data, site).workspaces
-        except AttributeError:
-            return []
+        if site not in self.workspaces_cache:
+            self.workspaces_cache[site] = self.section(site).get('workspaces', [])
+
+        return self.workspaces_cache[site]
+
+    @property
+    def cache_settings(self):
+        "enable_cache() arguments given in the [cache] section"
+        keys = dict(ttl='expire_after', max_entries='max_entries')
+        settings = {}
+        for key, value in self.section('cache').items():
+            if key not in keys:
+                continue
+
+            if not isinstance(value, int) or isinstance(value, bool) or value < 0:
+                raise ConfigError(f"'cache.{key}' must be a non-negative integer")
+
+            settings[keys[key]] = value
+
+        return settings
 
     @property
     def destdir(self):
-        try:
-            return Path(self.data.clone.destdir).expanduser()
-        except AttributeError:
+        destdir = self.section('clone').get('destdir')
+        if destdir is None:
             return Path.cwd()
 
-    # def is_valid(self):
-    #     if not set(self.toml.keys()).issubset(set('bitbucket')):
-    #         return False
+        return Path(destdir).expanduser()
 
-    #     return True
+    def is_valid(self):
+        return self.toml.keys() <= CONFIG_SECTIONS
 
     def __repr__(self):
         return "<Config '{}'>".format(self.fname)
@@ -349,6 +551,8 @@ class ConfigFile:
 
 
 class Credentials:
+    __slots__ = ('username', 'password')
+
     def __init__(self, credentials):
         self.username, self.password = credentials.split(':')
 
@@ -372,39 +576,122 @@ class Credentials:
 class Auth:
     def __init__(self, credentials):
         self.credentials = credentials
+        self.http_auth = None
+        self.user_pass = None
+        if credentials is not None:
+            self.http_auth = (credentials.username, credentials.password)
+            self.user_pass = '{}:{}@'.format(credentials.username, credentials.password)
+
+    def http_request(self, method, url, **kargs):
+        return http_request(method, url, auth=self.http_auth, **kargs)
+
+    def http_get(self, url, **kargs):
+        return http_get(url, auth=self.http_auth, **kargs)
+
+    def http_send(self, method, url, **kargs):
+        return http_send(method, url, auth=self.http_auth, **kargs)
 
     def auth(self, url):
+        "embed credentials in url, required for git https clones"
         assert url.startswith('https')
 
-        if self.credentials is None:
+        if self.user_pass is None:
             return url
 
-        parts = urlparse(url)
-        user_pass = '{}:{}@'.format(self.credentials.username, self.credentials.password)
-        netloc = parts.netloc
-        if '@' in netloc:
-            netloc = netloc.split('@')[1]
-
-        return urlunparse(parts._replace(netloc=user_pass + netloc))
+        scheme, _, rest = url.partition('://')
+        netloc, slash, path = rest.partition('/')
+        netloc = netloc.rpartition('@')[2]
+        return scheme + '://' + self.user_pass + netloc + slash + path
 
 
 def safe_url(url):
     if '@' not in url:
         return url
 
-    parts = urlparse(url)
+    return URL_PASSWORD_RE.sub(r'\1:****@', url)
 
-    # FIXME: regex?
-    user_pass, plain_netloc = parts.netloc.split('@')
-    username = user_pass.split(':')[0]
-    safe_netloc = '{}:{}@{}'.format(username, '****', plain_netloc)
-    return urlunparse(parts._replace(netloc=safe_netloc))
+
+def load_missing_sizes(repos):
+    "some listings omit the size of (fork) repos, get their full data concurrently"
+    pending = [repo for repo in repos if 'size' not in repo._data]
+    if not pending:
+        return
+
+    with ThreadPoolExecutor(max_workers=HTTP_WORKERS) as pool:
+        for repo, data in zip(pending, pool.map(lambda repo: repo._load_full_data(), pending)):
+            repo._data.update(data)
+
+
+def fetch_pages(get_page, urls):
+    "pages with known urls, fetched concurrently and yielded in order"
+    with ThreadPoolExecutor(max_workers=HTTP_WORKERS) as pool:
+        yield from pool.map(get_page, urls)
+
+
+def prefetch(pages):
+    "iterate pages in a background thread, fetching one page ahead of the consumer"
+    slot = queue.Queue(maxsize=1)
+    stop = threading.Event()
+    done = object()
+
+    def put(item):
+        "False if the consumer stopped, nobody will take the item"
+        while not stop.is_set():
+            try:
+                slot.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+
+        return False
+
+    def produce():
+        try:
+            for page in pages:
+                if not put((page, None)):
+                    return
+            put((done, None))
+        except Exception as e:
+            put((None, e))
+
+    threading.Thread(target=produce, daemon=True).start()
+    try:
+        while True:
+            page, error = slot.get()
+            if error is not None:
+                raise error
+            if page is done:
+                return
+            yield page
+    finally:
+        # ends the producer if the consumer stops early
+        stop.set()
+
+
+def data_field(key):
+    return property(lambda self: self.field(key))
 
 
 class Repo(Auth):
+    def __init__(self, name, credentials=None):
+        self.ref = RepoRef.cast(name, site=self.site)
+
+        super().__init__(credentials)
+        self._data = dict(
+            full_name=self.ref.full_name,
+            slug=self.ref.slug)
+
+        # full_name is already '{owner}/{repo}'
+        self.url = self.BASE_URL + self.ref.full_name
+
     def check(self):
-        "check access to server"
-        self.webpage
+        "check access to server, HEAD avoids downloading the repository data"
+        # HEAD does not change anything, so it must not clear the HTTP cache
+        result = self.http_send('HEAD', self.url)
+        if result.status_code == 405:
+            result = self.http_get(self.url)
+
+        self.reply_check(result)
         return True
 
     def exists(self):
@@ -417,65 +704,93 @@ class Repo(Auth):
     def checked_exists(self):
         "Renamed repos keep old URLs, so must verify same slug"
         try:
-            if not self.exists():
-                return False
-
-            self._load_full_data()
-            return self.slug == self.name
+            data = self._load_full_data()
         except RepositoryNotFound:
-            pass
+            return False
 
-        return False
+        self._data.update(data)
+        return self.ref.slug == data['name']
 
     def _load_full_data(self):
-        logging.debug(self.url)
+        logger.debug("%s", self.url)
 
         # FIXME: catch connection exceptions
-        result = http_get(self.url)
-        self.reply_check(result)
-        retval = result.json()
+        retval = get_repo_data(self.url, self.http_auth, self.reply_check)
         retval['access'] = self._get_access(retval)
         retval['size'] = self._get_size(retval)
         return retval
 
-    @lru_cache()
-    def __getattr__(self, attr):
+    def field(self, key):
+        "full data is loaded on first missing field"
         try:
-            return self._data[attr]
+            return self._data[key]
         except KeyError:
             self._data.update(self._load_full_data())
             try:
-                return self._data[attr]
+                return self._data[key]
             except KeyError:
-                raise AttributeError(attr)
+                raise AttributeError(key)
+
+    name = data_field('name')
+    scm = data_field('scm')
+    slug = data_field('slug')
+    full_name = data_field('full_name')
+    size = data_field('size')
+    access = data_field('access')
 
     @classmethod
     def from_dir(cls, dirname, credentials=None):
+        origin = cls.origin_url(dirname)
+        logger.debug("%s", origin)
+        repo_ref = RepoRef.from_origin(origin)
+        return cls.make(repo_ref, credentials)
+
+    @classmethod
+    def origin_url(cls, dirname):
+        "a 'git config' run is much faster than loading GitPython"
+        if dirname is None:
+            raise DirectoryIsNotRepository(dirname)
+
+        git_dir = Path(dirname) / '.git'
+        try:
+            result = subprocess.run(
+                ['git', '--git-dir', str(git_dir), 'config', '--get', 'remote.origin.url'],
+                capture_output=True, text=True)
+        except OSError:
+            return cls.origin_url_gitpython(dirname)
+
+        if result.returncode == 0:
+            return result.stdout.strip()
+
+        # 1: the key is missing, other codes: not a repository
+        if result.returncode == 1 and git_dir.exists():
+            raise MissingRemoteOrigin(dirname)
+
+        raise DirectoryIsNotRepository(dirname)
+
+    @classmethod
+    def origin_url_gitpython(cls, dirname):
+        import git
+
         try:
-            origin = git.Repo(dirname).remote().url
+            return git.Repo(dirname).remote().url
         except git.exc.InvalidGitRepositoryError:
             raise DirectoryIsNotRepository(dirname)
         except ValueError:
             raise MissingRemoteOrigin(dirname)
 
-        logging.debug(origin)
-        repo_ref = RepoRef.from_origin(origin)
-        return cls.make(repo_ref, credentials)
-
     @classmethod
     def make(cls, repo_ref, credentials):
-        repo_classes = {
-            'github': GithubRepo,
-            'bitbucket': BitbucketRepo,
-        }
-
         try:
-            repo_class = repo_classes[repo_ref.site]
+            repo_class = REPO_CLASSES[repo_ref.site]
         except KeyError:
             raise UnsupportedSite(repo_ref.site)
 
         return repo_class(repo_ref, credentials.get(repo_ref.site))
 
+    def clone_link(self, proto):
+        return self.clone_links[proto]
+
     def __repr__(self):
         return "<{} '{}'>".format(self.__class__.__name__, self.ref.global_name)
 
@@ -498,19 +813,33 @@ class Repo(Auth):
         return retval
 
     def clone(self, destdir, proto='ssh'):
-        def dash(*data):
-            print('-', end='', flush=True)
+        import git
 
-        url = self.clone_links[proto]
+        last_dash = 0
+
+        def dash(*data):
+            nonlocal last_dash
+            # git reports progress very often, a dash every 100ms is enough
+            if not sys.stdout.isatty():
+                return
+
+            now = time.monotonic()
+            if now - last_dash >= 0.1:
+                last_dash = now
+                sys.stdout.write('-')
+                sys.stdout.flush()
+
+        url = self.clone_link(proto)
         if proto == 'https':
             url = self.auth(url)
 
-        logging.debug(url)
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("%s", safe_url(url))
 
         try:
             git.Repo.clone_from(url, destdir, progress=dash)
         except git.exc.GitCommandError as e:
-            logging.error("cloning failed.")
+            logger.error("cloning failed.")
             if proto == 'https':
                 raise e
 
@@ -522,7 +851,7 @@ def api_check(reply, expected, raises):
     expected = expected or [200]
     raises = raises or {}
     code = reply.status_code
-    logging.debug(reply)
+    logger.debug("%s", reply)
 
     if code in expected:
         return
@@ -545,14 +874,14 @@ class Bitbucket:
             return
 
         content_type = reply.headers.get('Content-Type')
-        logging.debug("Reply Content-Type: '{}'".format(content_type))
+        logger.debug("Reply Content-Type: '%s'", content_type)
 
         if 'application/json' not in content_type:
             if 'text/html' not in content_type:
                 msg += '\n' + reply.text
             raise RemoteError(msg)
 
-        error = reply.json()['error']
+        error = reply_json(reply)['error']
         msg += '\n' + error['message']
         if 'detail' in error:
             msg += '\n' + json.dumps(error['detail'], indent=2)
@@ -570,29 +899,19 @@ class Github:
         if msg is None:
             return
 
-        reply_json = reply.json()
+        content = reply_json(reply)
 
-        if 'message' in reply_json:
-            msg += '\n' + reply_json['message']
-        if 'errors' in reply_json:
-            msg += '\n' + reply_json['errors'][0]['message']
+        if 'message' in content:
+            msg += '\n' + content['message']
+        if 'errors' in content:
+            msg += '\n' + content['errors'][0]['message']
 
         raise RemoteError(msg)
 
 
 class BitbucketRepo(Repo):
-    BASE_URL = 'https://api.bitbucket.org/2.0/repositories/{owner}/{repo}'
-
-    def __init__(self, name, credentials=None):
-        self.ref = RepoRef.cast(name, site='bitbucket')
-
-        super().__init__(credentials)
-        self._data = dict(
-            full_name=self.ref.full_name,
-            slug=self.ref.slug)
-
-        self.url = self.auth(self.BASE_URL.format(
-            owner=self.ref.owner.workspace, repo=self.ref.slug))
+    site = 'bitbucket'
+    BASE_URL = 'https://api.bitbucket.org/2.0/repositories/'
 
     def reply_check(self, reply, expected=None, raises=None):
         raises = raises or {}
@@ -609,11 +928,16 @@ class BitbucketRepo(Repo):
             scm=data['scm'],
             slug=data['slug'],
             full_name=data['full_name'],
-            size=cls._get_size(data),
             access=cls._get_access(data)
         ))
+        if data.get('size') is not None:
+            instance._data['size'] = cls._get_size(data)
+        if 'links' in data:
+            instance._data['links'] = data['links']
         return instance
 
+    links = data_field('links')
+
     @classmethod
     def _get_access(cls, data):
         return 'private' if data['is_private'] else 'public'
@@ -622,8 +946,7 @@ class BitbucketRepo(Repo):
     def _get_size(cls, data):
         return float(data['size']) / 1000
 
-    @property
-    @lru_cache()
+    @cached_property
     def clone_links(self):
         '''Example:
            "clone": [
@@ -636,23 +959,26 @@ class BitbucketRepo(Repo):
                 "name": "ssh"
             }
         ]'''
-        retval = {}
+        return {link['name']: link['href'] for link in self.links['clone']}
+
+    def clone_link(self, proto):
         for link in self.links['clone']:
-            retval[link['name']] = link['href']
-        return retval
+            if link['name'] == proto:
+                return link['href']
 
-    @property
-    @lru_cache()
+        raise KeyError(proto)
+
+    @cached_property
     def webpage(self):
         return self.links['html']['href']
 
     def last_commits(self, max_=3):
-        commits_url = self.url + '/commits'
-        result = http_get(commits_url)
+        commits_url = self.url + '/commits?pagelen={}'.format(max_)
+        result = self.http_get(commits_url)
         self.reply_check(result)
-        commits = result.json()['values']
+        commits = reply_json(result)['values']
 
-        for c in commits[:3]:
+        for c in commits[:max_]:
             yield dict(
                 hash    = c['hash'],
                 author  = c['author']['raw'],
@@ -660,64 +986,53 @@ class BitbucketRepo(Repo):
                 message = c['message'])
 
     def create(self, private=True):
-        result = requests.post(self.url, data={'is_private':private})
+        result = self.http_request('POST', self.url, data={'is_private':private})
         self.reply_check(result, raises={
             400: AlreadyExists(self.ref)
         })
         return self.slug
 
     def delete(self):
-        self.reply_check(requests.delete(self.url), [204])
+        self.reply_check(self.http_request('DELETE', self.url), [204])
 
     def rename(self, new_name):
         if '/' in new_name:
             raise error('New name must have no workspace, transfer is not supported')
 
+        # PUT creates missing repositories, so existence must be checked first
         self.check()
 
         # FIXME: this is required also on create
-        result = requests.put(self.url, data={'name': new_name})
+        result = self.http_request('PUT', self.url, data={'name': new_name})
         self.reply_check(result)
         real_name = result.headers['Location'].split('/')[-1]
         return real_name
 
-    @property
-    @lru_cache()
+    @cached_property
     def permissions(self):
         URL = 'https://api.bitbucket.org/2.0/user/permissions/repositories?q=repository.name="{}"'
-        url = self.auth(URL.format(self.ref.slug))
-        print(url)
-        result = http_get(url)
-        print(self.ref)
+        url = URL.format(self.ref.slug)
+        logger.debug("%s", url)
+        result = self.http_get(url)
         self.reply_check(result)
-        result = result.json()
+        result = reply_json(result)
 
         if len(result['values']) == 0:
             return 'none'
 
-        print(len(result['values']), result['values'])
+        logger.debug("%s permissions: %s", self.ref, result['values'])
 
         result = [r for r in result['values'] if r['repository']['full_name'] == self.ref.full_name][0]
         return result['permission']
 
 
 class GithubRepo(Repo):
-    BASE_URL = 'https://api.github.com/repos/{owner}/{repo}'
+    site = 'github'
+    BASE_URL = 'https://api.github.com/repos/'
     ORG_URL  = 'https://api.github.com/orgs/{org}/repos'
     OWNER_URL = 'https://api.github.com/user/repos'
 
     # FIXME: refactor superclass
-    def __init__(self, name, credentials=None):
-        self.ref = RepoRef.cast(name, site='github')
-
-        super().__init__(credentials)
-        self._data = dict(
-            full_name=self.ref.full_name,
-            slug=self.ref.slug)
-
-        self.url = self.auth(self.BASE_URL.format(
-            owner=self.ref.owner.workspace, repo=self.ref.slug))
-
     def reply_check(self, reply, expected=None, raises=None):
         raises = raises or {}
         raises.update({
@@ -733,11 +1048,20 @@ class GithubRepo(Repo):
             scm='git',
             slug=data['name'],
             full_name=data['full_name'],
-            size=cls._get_size(data),
             access=cls._get_access(data)
         ))
+        if data.get('size') is not None:
+            instance._data['size'] = cls._get_size(data)
+        # listings already provide them, no need to get the full repository data
+        for key in ['ssh_url', 'clone_url', 'html_url']:
+            if key in data:
+                instance._data[key] = data[key]
         return instance
 
+    ssh_url = data_field('ssh_url')
+    clone_url = data_field('clone_url')
+    html_url = data_field('html_url')
+
     @classmethod
     def _get_access(self, data):
         return 'private' if data['private'] else 'public'
@@ -746,32 +1070,30 @@ class GithubRepo(Repo):
     def _get_size(cls, data):
         return float(data['size'])
 
-    @property
-    @lru_cache()
+    @cached_property
     def clone_links(self):
         return dict(
             ssh=self.ssh_url,
             https=self.clone_url
         )
 
-    @property
-    @lru_cache()
+    @cached_property
     def webpage(self):
         return self.html_url
 
     def last_commits(self, max_=3):
         # https://developer.github.com/v3/repos/commits/#list-commits
-        url = self.url + '/commits'
-        logging.debug(url)
+        url = self.url + '/commits?per_page={}'.format(max_)
+        logger.debug("%s", url)
 
-        result = http_get(url)
+        result = self.http_get(url)
         self.reply_check(result, [200, 409])
         if result.status_code == 409:
             return []
 
-        commits = result.json()
+        commits = reply_json(result)
 
-        for c in commits[:3]:
+        for c in commits[:max_]:
             yield dict(
                 hash    = c['sha'],
                 author  = "{} <{}>".format(
@@ -787,35 +1109,31 @@ class GithubRepo(Repo):
         return self.ORG_URL.format(org=self.ref.owner.workspace)
 
     def create(self, private=True):
-        url = self.auth(self.get_user_url())
-        logging.debug(url)
+        url = self.get_user_url()
+        logger.debug("%s", url)
 
-        result = requests.post(
-            url,
-            data=json.dumps({'name': self.slug, 'private': private}))
+        result = self.http_request(
+            'POST', url, json={'name': self.slug, 'private': private})
 
         self.reply_check(result, [201], raises={
             422: AlreadyExists(self.ref)
         })
-        real_name = result.json()['name']
+        real_name = reply_json(result)['name']
         return real_name
 
     def delete(self):
-        self.reply_check(requests.delete(self.url), [204])
+        self.reply_check(self.http_request('DELETE', self.url), [204])
 
     def rename(self, new_name):
         # FIXME: github API supports transfers
         if '/' in new_name:
             raise error('New name must have no workspace, transfer is not supported')
 
-        self.check()
-
-        result = requests.patch(
-            self.url,
-            data=json.dumps({'name': new_name}))
+        # a missing repository gets 404, handled by reply_check()
+        result = self.http_request('PATCH', self.url, json={'name': new_name})
 
         self.reply_check(result)
-        real_name = result.json()['name'].split('/')[-1]
+        real_name = reply_json(result)['name'].split('/')[-1]
         return real_name
 
 
@@ -829,7 +1147,12 @@ class Workspace(Auth):
 
 class BitbucketWorkspace(Workspace):
     site = 'bitbucket'
-    BASE_URL = 'https://api.bitbucket.org/2.0/repositories/{}?sort=slug'
+    BASE_URL = 'https://api.bitbucket.org/2.0/repositories/{}?sort=slug&fields={}'
+    # only what BitbucketRepo.from_data() requires, replies are several times smaller
+    FIELDS = str.join(',', [
+        'next', 'page', 'pagelen', 'size',
+        'values.scm', 'values.slug', 'values.full_name', 'values.size', 'values.is_private',
+        'values.links.clone', 'values.links.html'])
 
     def __init__(self, name, credentials):
         super().__init__(credentials)
@@ -837,23 +1160,39 @@ class BitbucketWorkspace(Workspace):
             name = WorkspaceName(name, 'bitbucket')
 
         self.name = name
-        self.url = self.BASE_URL.format(name.workspace)
+        self.url = self.BASE_URL.format(name.workspace, self.FIELDS)
+
+    def get_page(self, url):
+        result = self.http_get(url)
+        logger.debug("%s", url)
+        Bitbucket.api_check(result)
+        return reply_json(result)
+
+    def get_pages(self):
+        "first page gives the total size, so the remaining ones are fetched concurrently"
+        page = self.get_page(self.url)
+        yield page
+
+        if 'size' not in page:
+            yield from prefetch(self.next_pages(page))
+            return
+
+        npages = math.ceil(page['size'] / page['pagelen'])
+        urls = ['{}&page={}'.format(self.url, i) for i in range(2, npages + 1)]
+        yield from fetch_pages(self.get_page, urls)
+
+    def next_pages(self, page):
+        while page.get('next') is not None:
+            page = self.get_page(page['next'])
+            yield page
 
     def ls_repos(self):
-        next_link = self.url
-        while next_link is not None:
-            next_link = self.auth(next_link)
-            result = http_get(next_link)
-            logging.debug(next_link)
-            Bitbucket.api_check(result)
-
-            page = result.json()
-            next_link = page.get('next')
+        for page in self.get_pages():
             for repo in page['values']:
                 yield BitbucketRepo.from_data(repo, self.credentials)
 
     def check(self):
-        Bitbucket.api_check(http_get(self.auth(self.url)))
+        Bitbucket.api_check(self.http_get(self.url))
 
     def make_repo(self, reponame):
         return BitbucketRepo(
@@ -866,6 +1205,17 @@ class GithubWorkspace(Workspace):
     ORG_URL   = 'https://api.github.com/orgs/{org}/repos'
     USER_URL  = 'https://api.github.com/users/{user}/repos'
     OWNER_URL = 'https://api.github.com/user/repos'
+    GRAPHQL_URL = 'https://api.github.com/graphql'
+    GRAPHQL_QUERY = '''
+query($login: String!, $cursor: String) {
+  repositoryOwner(login: $login) {
+    repositories(first: 100, after: $cursor, ownerAffiliations: [OWNER],
+                 orderBy: {field: NAME, direction: ASC}) {
+      pageInfo { hasNextPage endCursor }
+      nodes { name nameWithOwner isPrivate diskUsage sshUrl url }
+    }
+  }
+}'''
 
     def __init__(self, name, credentials):
         super().__init__(credentials)
@@ -873,12 +1223,25 @@ class GithubWorkspace(Workspace):
             name = WorkspaceName(name, 'github')
 
         self.name = name
-        self.url = self.ORG_URL.format(org=name.workspace)
-        result = http_get(self.auth(self.url))
+        # organization or user listing url, resolved by first_page()
+        self.url = None
+
+    def first_page(self):
+        "the first listing request tells organizations and users apart"
+        if self.url is not None:
+            return self.get_page(self.url)
+
+        url = self.ORG_URL.format(org=self.name.workspace)
+        result = self.http_get(url)
         if result.status_code == 404:
-            logging.info("'{}' is not an organization. Trying as user.".format(
-                name.workspace))
-            self.url = self.get_user_url()
+            logger.info("'%s' is not an organization. Trying as user.", self.name.workspace)
+            url = self.get_user_url()
+            result = self.http_get(url)
+
+        logger.debug("%s", url)
+        Github.api_check(result)
+        self.url = url
+        return result
 
     def get_user_url(self):
         if self.credentials \
@@ -888,29 +1251,99 @@ class GithubWorkspace(Workspace):
         return self.USER_URL.format(user=self.name.workspace)
 
     def ls_repos(self):
-        def get_next_link(result):
-            try:
-                return result.links['next']['url']
-            except KeyError:
-                return None
+        "GraphQL (authenticated only) returns 100 repos per request, sizes included"
+        page = self.graphql_page(None) if self.credentials else None
+        if page is None:
+            yield from self.ls_repos_rest()
+            return
+
+        # cursors are only known page by page, so the next one is fetched in background
+        for page in prefetch(self.graphql_pages(page)):
+            for node in page['nodes']:
+                yield GithubRepo.from_data(self.graphql_to_rest(node), self.credentials)
+
+    def graphql_pages(self, page):
+        yield page
+        while page['pageInfo']['hasNextPage']:
+            page = self.graphql_page(page['pageInfo']['endCursor'])
+            if page is None:
+                raise RemoteError("GraphQL listing of '{}' failed".format(self.name))
+            yield page
+
+    def graphql_page(self, cursor):
+        "returns None if GraphQL is not usable: bad credentials, missing scopes or unknown owner"
+        variables = dict(login=self.name.workspace, cursor=cursor)
+        # read-only query, it must not invalidate the HTTP cache
+        reply = self.http_send('POST', self.GRAPHQL_URL,
+                               json=dict(query=self.GRAPHQL_QUERY, variables=variables))
+        logger.debug("GraphQL %s %s", self.name.workspace, cursor)
+        if reply.status_code != 200:
+            logger.info("GraphQL unavailable (%s), using REST API", reply.status_code)
+            return None
 
-        next_link = self.url
-        while next_link is not None:
-            next_link = self.auth(next_link)
-            result = http_get(next_link)
-            logging.debug(next_link)
-            Github.api_check(result)
+        owner = (reply_json(reply).get('data') or {}).get('repositoryOwner')
+        if owner is None:
+            return None
+
+        return owner['repositories']
+
+    @classmethod
+    def graphql_to_rest(cls, node):
+        return dict(
+            name=node['name'],
+            full_name=node['nameWithOwner'],
+            private=node['isPrivate'],
+            size=node['diskUsage'],
+            ssh_url=node['sshUrl'],
+            clone_url=node['url'] + '.git',
+            html_url=node['url'])
+
+    def get_page(self, url):
+        result = self.http_get(url)
+        logger.debug("%s", url)
+        Github.api_check(result)
+        return result
+
+    def get_pages(self):
+        "'last' link gives the page count, so the remaining ones are fetched concurrently"
+        result = self.first_page()
+        yield reply_json(result)
+
+        last = result.links.get('last', {}).get('url')
+        match = last and GITHUB_PAGE_RE.search(last)
+        if not match:
+            yield from prefetch(self.next_pages(result))
+            return
 
-            page = result.json()
-            next_link = get_next_link(result)
+        urls = [GITHUB_PAGE_RE.sub(r'\g<1>{}'.format(i), last)
+                for i in range(2, int(match.group(2)) + 1)]
+        yield from fetch_pages(lambda url: reply_json(self.get_page(url)), urls)
 
+    def next_pages(self, result):
+        while 'next' in result.links:
+            result = self.get_page(result.links['next']['url'])
+            yield reply_json(result)
+
+    def ls_repos_rest(self):
+        for page in self.get_pages():
             for repo in page:
                 yield GithubRepo.from_data(repo, self.credentials)
 
     def check(self):
-        Github.api_check(http_get(self.auth(self.url)))
+        self.first_page()
 
     def make_repo(self, reponame):
         return GithubRepo(
             RepoRef.from_parts(self.name.workspace, reponame, 'github'),
             self.credentials)
+
+
+REPO_CLASSES = {
+    'bitbucket': BitbucketRepo,
+    'github':    GithubRepo,
+}
+
+WORKSPACE_CLASSES = {
+    'bitbucket': BitbucketWorkspace,
+    'github':    GithubWorkspace,
+}
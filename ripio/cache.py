@@ -0,0 +1,201 @@
+import os
+import json
+import time
+import hashlib
+import logging
+from pathlib import Path
+
+logger = logging.getLogger(__name__)
+
+
+class HttpCache:
+    """on-disk store for successful GET replies, one json file per url and credentials.
+    Entries live the Cache-Control max-age of the reply, at most expire_after seconds.
+    Expired entries are revalidated with ETag/Last-Modified conditional requests."""
+
+    def __init__(self, path, expire_after=300, max_entries=1000):
+        self.path = Path(path).expanduser()
+        self.expire_after = expire_after
+        self.max_entries = max_entries
+
+    def fname(self, url, auth):
+        key = hashlib.sha256(repr((url, auth)).encode()).hexdigest()
+        return self.path / key
+
+    def get(self, url, auth, fetch):
+        "fetch(headers) performs the real request"
+        entry = self.load(url, auth)
+        if entry is not None and time.time() - entry['time'] <= self.max_age(entry):
+            logger.debug("cached reply for %s", url)
+            self.touch(url, auth)
+            return self.make_reply(entry)
+
+        reply = fetch(self.validators(entry))
+        if reply.status_code == 304 and entry is not None:
+            logger.debug("cached reply for %s is still valid", url)
+            entry['time'] = time.time()
+            self.save(url, auth, entry)
+            return self.make_reply(entry)
+
+        if reply.status_code == 200:
+            try:
+                self.save(url, auth, self.make_entry(url, reply))
+            except UnicodeDecodeError as e:
+                logger.debug("HTTP cache not saved: %s", e)
+            self.evict()
+
+        return reply
+
+    def load(self, url, auth):
+        try:
+            with self.fname(url, auth).open() as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def save(self, url, auth, entry):
+        fname = self.fname(url, auth)
+        tmp = fname.with_suffix('.tmp')
+
+        try:
+            self.path.mkdir(mode=0o700, parents=True, exist_ok=True)
+            with tmp.open('w') as f:
+                json.dump(entry, f)
+            os.replace(tmp, fname)
+        except OSError as e:
+            logger.debug("HTTP cache not saved: %s", e)
+
+    def touch(self, url, auth):
+        "file mtime is the last use, for evict()"
+        try:
+            os.utime(self.fname(url, auth))
+        except OSError as e:
+            logger.debug("HTTP cache not touched: %s", e)
+
+    def max_age(self, entry):
+        "seconds the entry is fresh, -1 when it must always be revalidated"
+        stored = {k.lower(): v for k, v in entry['headers'].items()}
+        directives = [d.strip().lower() for d in stored.get('cache-control', '').split(',')]
+        if 'no-cache' in directives or 'no-store' in directives:
+            return -1
+
+        for directive in directives:
+            if directive.startswith('max-age='):
+                try:
+                    return min(int(directive[len('max-age='):]), self.expire_after)
+                except ValueError:
+                    return -1
+
+        return self.expire_after
+
+    @classmethod
+    def validators(cls, entry):
+        if entry is None:
+            return {}
+
+        stored = {k.lower(): v for k, v in entry['headers'].items()}
+        headers = {}
+        etag = stored.get('etag')
+        if etag is not None:
+            headers['If-None-Match'] = etag
+
+        last_modified = stored.get('last-modified')
+        if last_modified is not None:
+            headers['If-Modified-Since'] = last_modified
+
+        return headers
+
+    def evict(self):
+        "drop the least recently used entries above max_entries"
+        try:
+            fnames = [f for f in self.path.iterdir() if f.suffix != '.tmp']
+            if len(fnames) <= self.max_entries:
+                return
+
+            fnames.sort(key=lambda f: f.stat().st_mtime)
+            for fname in fnames[:len(fnames) - self.max_entries]:
+                fname.unlink(missing_ok=True)
+        except OSError as e:
+            logger.debug("HTTP cache not evicted: %s", e)
+
+    def clear(self):
+        if not self.path.exists():
+            return
+
+        try:
+            for fname in self.path.iterdir():
+                fname.unlink(missing_ok=True)
+        except OSError as e:
+            logger.debug("HTTP cache not cleared: %s", e)
+
+    @classmethod
+    def make_entry(cls, url, reply):
+        return dict(
+            time=time.time(),
+            url=url,
+            status_code=reply.status_code,
+            reason=reply.reason,
+            headers={k: v for k, v in reply.headers.items()
+                     if k.lower() not in ['content-encoding', 'transfer-encoding']},
+            content=reply.content.decode('utf-8'))
+
+    @classmethod
+    def make_reply(cls, entry):
+        import requests
+        from requests.structures import CaseInsensitiveDict
+
+        reply = requests.Response()
+        reply.url = entry['url']
+        reply.status_code = entry['status_code']
+        reply.reason = entry['reason']
+        reply.headers = CaseInsensitiveDict(entry['headers'])
+        reply.encoding = 'utf-8'
+        reply._content = entry['content'].encode('utf-8')
+        return reply
+
+
+class NameCache:
+    """on-disk store for resolved repository names, a single json file.
+    Names not found anywhere expire in minutes, repositories may be created elsewhere."""
+
+    def __init__(self, fname, expire_after=24 * 3600, expire_missing=300):
+        self.fname = Path(fname).expanduser()
+        self.expire_after = expire_after
+        self.expire_missing = expire_missing
+
+    def get(self, key):
+        entry = self.load().get(key)
+        if entry is None:
+            return None
+
+        ttl = self.expire_after if entry['found'] else self.expire_missing
+        if time.time() - entry['time'] > ttl:
+            return None
+
+        logger.debug("cached completion for '%s'", key)
+        return entry['found']
+
+    def set(self, key, found):
+        entries = self.load()
+        entries[key] = dict(time=time.time(), found=found)
+        self.save(entries)
+
+    def load(self):
+        try:
+            with self.fname.open() as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def save(self, entries):
+        tmp = self.fname.with_suffix('.tmp')
+        try:
+            self.fname.parent.mkdir(mode=0o700, parents=True, exist_ok=True)
+            with tmp.open('w') as f:
+                json.dump(entries, f)
+            os.replace(tmp, self.fname)
+        except OSError as e:
+            logger.debug("name cache not saved: %s", e)
+
+    def clear(self):
+        self.fname.unlink(missing_ok=True)
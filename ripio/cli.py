@@ -3,6 +3,8 @@
 import os
 import sys
 import argparse
+import shlex
+import itertools
 import logging
 from pathlib import Path
 import webbrowser
@@ -13,13 +15,15 @@ import ripio.utils as utils
 
 warnings.filterwarnings('ignore')
 
+LS_BATCH = 64
+
 
 def set_verbosity(args):
     level = logging.ERROR - 10 * min(args.verbosity, 3)
     if level != logging.ERROR:
         print("Verbosity set to {}".format(logging.getLevelName(level)))
         print("Try 'ripio -vvv' for even more detail")
-    logging.getLogger().setLevel(level)
+    ripio.configure_logging(level)
 
 
 def get_repo(config, name=None, guess=True):
@@ -35,6 +39,8 @@ def get_repo(config, name=None, guess=True):
         # FIXME: refactor this handler
         print(f"- trying to complete '{name}' at known workspaces...")
         completion = ripio.Completion(name, config.config_file)
+        if completion.cached:
+            print("- cached completion, use --refresh to check the sites again")
 
         if len(completion.found) == 1:
             repo_ref = ripio.RepoRef(completion.found[0])
@@ -56,19 +62,24 @@ def cwd_repo(config):
 
 def cmd_ls_repos(config):
     ws_name = ripio.WorkspaceName(config.owner)
-    if ws_name.site not in ['bitbucket', 'github']:
+    try:
+        ws_class = ripio.WORKSPACE_CLASSES[ws_name.site]
+    except KeyError:
         raise ripio.UnsupportedSite(ws_name.site)
 
-    credentials = config.credentials.get(ws_name.site)
+    ws = ws_class(ws_name, config.credentials.get(ws_name.site))
 
-    if ws_name.site == 'bitbucket':
-        ws = ripio.BitbucketWorkspace(ws_name, credentials)
-    else:
-        ws = ripio.GithubWorkspace(ws_name, credentials)
+    # stdout is unbuffered (python -u), so write lines in batches
+    repos = enumerate(ws.ls_repos(), 1)
+    while True:
+        batch = list(itertools.islice(repos, LS_BATCH))
+        if not batch:
+            break
 
-    fmt = "{0:>4}. {1:>12,} KB - {2.scm:<3} - {2.access:<7} - {2.full_name:<20}"
-    for i, repo in enumerate(ws.ls_repos()):
-        print(fmt.format(i+1, repo.size, repo))
+        ripio.load_missing_sizes(repo for i, repo in batch)
+        sys.stdout.write(str.join('', [
+            f"{i:>4}. {repo.size:>12,} KB - {repo.scm:<3} - "
+            f"{repo.access:<7} - {repo.full_name:<20}\n" for i, repo in batch]))
 
 
 def cmd_print_head(config):
@@ -169,16 +180,63 @@ def cmd_help(config):
     config.parser.print_help()
 
 
+# they read the user answer from stdin
+INTERACTIVE_COMMANDS = [cmd_repo_delete]
+
+
+def cmd_batch(config):
+    "run commands in the same process: config, imports and connections are reused"
+    failed = 0
+    for line in config.file:
+        line = line.strip()
+        if not line or line.startswith('#'):
+            continue
+
+        print(f"-- {line}")
+        try:
+            command = config.parser.parse_args(
+                shlex.split(line), namespace=BaseConfig(verbosity=config.verbosity))
+        except SystemExit:
+            failed += 1
+            continue
+
+        if getattr(command, 'func', cmd_batch) is cmd_batch:
+            print("- not a runnable batch command")
+            failed += 1
+            continue
+
+        if config.file is sys.stdin and command.func in INTERACTIVE_COMMANDS:
+            print("- interactive command, not available reading from stdin")
+            failed += 1
+            continue
+
+        command.config = config.config
+        command.set_config_file(config.config_file)
+        command.parser = config.parser
+        try:
+            command.func(command)
+        except ripio.error as e:
+            print(e)
+            failed += 1
+        except SystemExit:
+            failed += 1
+
+    if failed:
+        raise ripio.BatchFailed(failed)
+
+
 class BaseConfig(argparse.Namespace):
     def load_file(self):
         if os.path.exists(self.config):
-            self.config_file = ripio.ConfigFile(self.config)
+            self.set_config_file(ripio.ConfigFile(self.config))
         else:
             raise ripio.MissingConfig
 
         # FIXME: verbosity argument does not affect this, it is previous to setLevel
         # logging.debug("Loading config '{}'".format(self.config_file.fname))
 
+    def set_config_file(self, config_file):
+        self.config_file = config_file
         self.destdir = self.config_file.destdir
 
     @property
@@ -189,36 +247,15 @@ class BaseConfig(argparse.Namespace):
             }
 
 
-def run():
-    repo_help = 'repo ref (site:owner/slug), url or name'
-
-    parser = argparse.ArgumentParser(
-        formatter_class=argparse.RawTextHelpFormatter,
-        description='''\
-Manage hosted git repositories.
-
-General repository reference format is: 'site:owner/name', like:
-- 'github:twitter/wordpress' or 'gh:twitter/wordpress'
-- 'bitbucket:paypal/example' or 'bb:paypal/example'
-
-Abbreviated references are allowed (when 'workspaces' are configured):
-- 'example'
-- 'github:example' o 'gh:example'
-
-URLs are valid too:
-- 'https://github.com/twitter/wordpress'
-- 'git@github.com:twitter/wordpress.git'
-''' + ripio.CONFIG_USAGE)
+REPO_HELP = 'repo ref (site:owner/slug), url or name'
 
-    parser.add_argument('--config', help='alternate config file',
-                        default=Path.home() / '.config/ripio')
-    parser.add_argument('-v', '--verbosity', action='count', default=0,
-                        help='verbosity level. -v:INFO, -vv:DEBUG')
-    cmds = parser.add_subparsers()
 
+def add_help_parser(cmds):
     parser_help = cmds.add_parser('help', help='show help')
     parser_help.set_defaults(func=cmd_help)
 
+
+def add_ls_parser(cmds):
     parser_ls = cmds.add_parser(
         'ls', help='list repositories',
         formatter_class=argparse.RawTextHelpFormatter,
@@ -233,16 +270,22 @@ Abbreviated names are allowed when suitable configuration is given.
     parser_ls.set_defaults(func=cmd_ls_repos)
     parser_ls.add_argument('owner', help='team or user')
 
+
+def add_head_parser(cmds):
     parser_head = cmds.add_parser('head', help='show last commits')
     parser_head.set_defaults(func=cmd_print_head)
-    parser_head.add_argument('repo', help=repo_help)
+    parser_head.add_argument('repo', help=REPO_HELP)
 
+
+def add_rename_parser(cmds):
     parser_rename = cmds.add_parser('rename', help='rename repository')
     parser_rename.set_defaults(func=cmd_repo_rename)
-    parser_rename.add_argument('repo', help=repo_help)
+    parser_rename.add_argument('repo', help=REPO_HELP)
     parser_rename.add_argument('new_name', metavar='new-name',
                                help='new repository name')
 
+
+def add_create_parser(cmds):
     parser_create = cmds.add_parser('create', help='create new repository')
     parser_create.set_defaults(func=cmd_repo_create)
     parser_create.add_argument('--public', dest='private', default=True,
@@ -250,12 +293,16 @@ Abbreviated names are allowed when suitable configuration is given.
                                help='set public, default is private')
     parser_create.add_argument('--clone', action='store_true',
                                help='clone after create')
-    parser_create.add_argument('repo', help=repo_help)
+    parser_create.add_argument('repo', help=REPO_HELP)
 
+
+def add_delete_parser(cmds):
     parser_delete = cmds.add_parser('delete', help='delete a repository')
     parser_delete.set_defaults(func=cmd_repo_delete)
-    parser_delete.add_argument('repo', help=repo_help)
+    parser_delete.add_argument('repo', help=REPO_HELP)
+
 
+def add_clone_parser(cmds):
     parser_clone = cmds.add_parser('clone', help='clone a repository')
     parser_clone.set_defaults(func=cmd_repo_clone)
     parser_clone.add_argument('--http', dest='proto', default='ssh',
@@ -263,21 +310,111 @@ Abbreviated names are allowed when suitable configuration is given.
                               help='Use HTTP instead of SSH')
     parser_clone.add_argument('--destdir', default=Path.cwd(), type=Path,
                               help='directory where save repository')
-    parser_clone.add_argument('repo', help=repo_help)
+    parser_clone.add_argument('repo', help=REPO_HELP)
+
 
+def add_config_parser(cmds):
     parser_config = cmds.add_parser('config', help='show config')
     parser_config.set_defaults(func=cmd_show_config)
 
+
+def add_site_parser(cmds):
     parser_site = cmds.add_parser('site', help='open webpage for the current repository')
     parser_site.set_defaults(func=cmd_site)
 
+
+def add_info_parser(cmds):
     parser_info = cmds.add_parser('info', help='show repository info')
     parser_info.set_defaults(func=cmd_info)
-    parser_info.add_argument('repo', nargs='?', help=repo_help)
+    parser_info.add_argument('repo', nargs='?', help=REPO_HELP)
+
+
+def add_batch_parser(cmds):
+    parser_batch = cmds.add_parser(
+        'batch', help='run commands from a file',
+        formatter_class=argparse.RawTextHelpFormatter,
+        description='''\
+Run one ripio command per line, like:
+    rename bb:paypal/example example-old
+    delete gh:twitter/wordpress
+
+Empty lines and lines starting with '#' are ignored.
+Commands asking for confirmation (delete) need a file, not stdin.
+''')
+    parser_batch.set_defaults(func=cmd_batch)
+    parser_batch.add_argument('file', type=argparse.FileType('r'),
+                              help="commands file, '-' for stdin")
+
+
+SUBPARSERS = {
+    'help':   add_help_parser,
+    'ls':     add_ls_parser,
+    'head':   add_head_parser,
+    'rename': add_rename_parser,
+    'create': add_create_parser,
+    'delete': add_delete_parser,
+    'clone':  add_clone_parser,
+    'config': add_config_parser,
+    'site':   add_site_parser,
+    'info':   add_info_parser,
+    'batch':  add_batch_parser,
+}
+
+
+def requested_subparsers(argv):
+    "only the chosen command parser is needed, all of them for global help or errors"
+    for arg in argv:
+        # batch lines may run any command
+        if arg in ['-h', '--help', 'help', 'batch']:
+            break
+
+        if arg in SUBPARSERS:
+            return [SUBPARSERS[arg]]
+
+    return SUBPARSERS.values()
+
+
+def run():
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.RawTextHelpFormatter,
+        description='''\
+Manage hosted git repositories.
+
+General repository reference format is: 'site:owner/name', like:
+- 'github:twitter/wordpress' or 'gh:twitter/wordpress'
+- 'bitbucket:paypal/example' or 'bb:paypal/example'
+
+Abbreviated references are allowed (when 'workspaces' are configured):
+- 'example'
+- 'github:example' o 'gh:example'
+
+URLs are valid too:
+- 'https://github.com/twitter/wordpress'
+- 'git@github.com:twitter/wordpress.git'
+''' + ripio.CONFIG_USAGE)
+
+    parser.add_argument('--config', help='alternate config file',
+                        default=Path.home() / '.config/ripio')
+    parser.add_argument('-v', '--verbosity', action='count', default=0,
+                        help='verbosity level. -v:INFO, -vv:DEBUG')
+    parser.add_argument('--no-cache', dest='cache', action='store_false',
+                        help='ignore cached API replies')
+    parser.add_argument('--refresh', action='store_true',
+                        help='revalidate cached API replies with the server')
+    cmds = parser.add_subparsers()
+    for add_subparser in requested_subparsers(sys.argv[1:]):
+        add_subparser(cmds)
 
     config = parser.parse_args(namespace=BaseConfig())
     config.load_file()
     set_verbosity(config)
+    settings = config.config_file.cache_settings
+    if config.cache and config.refresh:
+        # every entry is stale, unchanged replies are still reused on 304
+        ripio.enable_cache(**dict(settings, expire_after=0))
+    elif config.cache:
+        ripio.enable_cache(**settings)
+        ripio.enable_name_cache()
 
     if not hasattr(config, 'func'):
         parser.print_help()
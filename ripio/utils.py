@@ -1,6 +1,5 @@
 import os
 import sys
-from collections import namedtuple
 from pathlib import Path
 
 
@@ -31,14 +30,6 @@ def pretty_path(path):
     return str(path).replace(str(Path.home()), '~')
 
 
-# https://stackoverflow.com/a/46813147/722624
-def dictToObject(d):
-    for k, v in d.items():
-        if isinstance(v, dict):
-            d[k] = dictToObject(v)
-    return namedtuple('object', d.keys())(*d.values())
-
-
 def resolve_path(fname, paths, find_all=False):
     retval = []
     for p in paths: